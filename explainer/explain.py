@@ -3,6 +3,7 @@
     Implementation of the explainer. 
 """
 
+import contextlib
 import math
 import time
 import os
@@ -39,6 +40,13 @@ FloatTensor = torch.cuda.FloatTensor if use_cuda else torch.FloatTensor
 LongTensor = torch.cuda.LongTensor if use_cuda else torch.LongTensor
 Tensor = FloatTensor
 
+# eager epochs run before the optimization step is captured into a CUDA graph
+CUDA_GRAPH_WARMUP_EPOCHS = 3
+# optimizers whose step() can be captured: adam with capturable=True keeps its step
+# counter on the device, sgd has no counter and rmsprop never reads its host-side one
+CUDA_GRAPH_OPTIMIZERS = ("adam", "sgd", "rmsprop")
+CAPTURABLE_OPTIMIZERS = ("adam",)
+
 class Explainer:
     def __init__(
         self,
@@ -64,10 +72,20 @@ class Explainer:
         self.n_hops = args.num_gc_layers
         self.graph_mode = graph_mode
         self.graph_idx = graph_idx
-        self.neighborhoods = None if self.graph_mode else graph_utils.neighborhoods(adj=self.adj, n_hops=self.n_hops, use_cuda=use_cuda)
+        self.neighborhoods = None if self.graph_mode else graph_utils.neighborhoods(adj=self.adj, n_hops=self.n_hops)
         self.args = args
         self.writer = writer
         self.print_training = print_training
+        # device copies of adj and feat, from which the subgraphs are gathered
+        device = "cuda" if args.gpu else "cpu"
+        self._adj_t = torch.as_tensor(adj, dtype=torch.float, device=device)
+        self._feat_t = torch.as_tensor(feat, dtype=torch.float, device=device)
+        # memory pool shared by the CUDA graphs of all explanations
+        self.cuda_graph_pool = None
+        # the GCN is compiled once for all explanations. Shapes stay static, since
+        # dynamic=True fails to lower GraphConv's matmul in torch 2.0, so each new
+        # neighborhood size is compiled once (up to dynamo's cache_size_limit)
+        self.explain_model = torch.compile(self.model) if args.compile else self.model
 
     
     # Main method
@@ -79,23 +97,26 @@ class Explainer:
         # index of the query node in the new adj
         if graph_mode:
             node_idx_new = node_idx
-            sub_adj = self.adj[graph_idx]
-            sub_feat = self.feat[graph_idx, :]
+            adj = self._adj_t[graph_idx].unsqueeze(0).clone()
+            x = self._feat_t[graph_idx].unsqueeze(0).clone()
             sub_label = self.label[graph_idx]
             neighbors = np.asarray(range(self.adj.shape[0]))
         else:
             print("node label: ", self.label[graph_idx][node_idx])
-            node_idx_new, sub_adj, sub_feat, sub_label, neighbors = self.extract_neighborhood(
-                node_idx, graph_idx
-            )
+            node_idx_new, neighbors = self.neighbor_indices(node_idx, graph_idx)
             print("neigh graph idx: ", node_idx, node_idx_new)
-            sub_label = np.expand_dims(sub_label, axis=0)
-        
-        sub_adj = np.expand_dims(sub_adj, axis=0)
-        sub_feat = np.expand_dims(sub_feat, axis=0)
+            # gather the neighborhood on the device rather than through numpy
+            neighbors_t = torch.from_numpy(neighbors).to(self._adj_t.device)
+            adj = (
+                self._adj_t[graph_idx]
+                .index_select(0, neighbors_t)
+                .index_select(1, neighbors_t)
+                .unsqueeze(0)
+            )
+            x = self._feat_t[graph_idx].index_select(0, neighbors_t).unsqueeze(0)
+            sub_label = np.expand_dims(self.label[graph_idx][neighbors], axis=0)
 
-        adj   = torch.tensor(sub_adj, dtype=torch.float)
-        x     = torch.tensor(sub_feat, requires_grad=True, dtype=torch.float)
+        x.requires_grad_()
         label = torch.tensor(sub_label, dtype=torch.long)
 
         if self.graph_mode:
@@ -104,12 +125,17 @@ class Explainer:
         else:
             pred_label = np.argmax(self.pred[graph_idx][neighbors], axis=1)
             print("Node predicted label: ", pred_label[node_idx_new])
+        # the predicted labels do not change during the optimization
+        pred_label_t = torch.tensor(
+            pred_label, dtype=torch.float, device="cuda" if self.args.gpu else "cpu"
+        )
 
         explainer = ExplainModule(
             adj=adj,
             x=x,
-            model=self.model,
+            model=self.explain_model,
             label=label,
+            pred_label_t=pred_label_t,
             args=self.args,
             writer=self.writer,
             graph_idx=self.graph_idx,
@@ -130,22 +156,60 @@ class Explainer:
             )[graph_idx]
             masked_adj = adj_grad + adj_grad.t()
             masked_adj = nn.functional.sigmoid(masked_adj)
-            masked_adj = masked_adj.cpu().detach().numpy() * sub_adj.squeeze()
+            masked_adj = (masked_adj * explainer.adj[0]).cpu().detach().numpy()
         else:
             explainer.train()
             begin_time = time.time()
+            # steps that write to tensorboard, update the lr or build new modules
+            # (batch norm in the GCN) cannot be captured
+            use_cuda_graph = (
+                self.args.gpu
+                and self.args.cuda_graph
+                and model == "exp"
+                and self.writer is None
+                and explainer.scheduler is None
+                and not self.model.bn
+                and self.args.opt in CUDA_GRAPH_OPTIMIZERS
+            )
+            warmup_stream = torch.cuda.Stream() if use_cuda_graph else None
+            if warmup_stream is not None:
+                warmup_stream.wait_stream(torch.cuda.current_stream())
+            step_graph = None
             for epoch in range(self.args.num_epochs):
-                explainer.zero_grad()
-                explainer.optimizer.zero_grad()
-                ypred, adj_atts = explainer(node_idx_new, unconstrained=unconstrained)
-                loss = explainer.loss(ypred, pred_label, node_idx_new, epoch)
-                loss.backward()
-
-                explainer.optimizer.step()
-                if explainer.scheduler is not None:
-                    explainer.scheduler.step()
+                if use_cuda_graph and epoch == CUDA_GRAPH_WARMUP_EPOCHS:
+                    if self.cuda_graph_pool is None:
+                        self.cuda_graph_pool = torch.cuda.graph_pool_handle()
+                    step_graph, step_outputs = explainer.capture_step(
+                        node_idx_new,
+                        pred_label,
+                        unconstrained=unconstrained,
+                        pool=self.cuda_graph_pool,
+                    )
 
-                mask_density = explainer.mask_density()
+                if step_graph is not None:
+                    step_graph.replay()
+                    ypred, adj_atts, loss = step_outputs
+                else:
+                    # the warmup epochs preceding a capture run on a side stream
+                    with torch.cuda.stream(warmup_stream):
+                        explainer.zero_grad(set_to_none=True)
+                        explainer.optimizer.zero_grad(set_to_none=True)
+                        with explainer.autocast():
+                            ypred, adj_atts = explainer(
+                                node_idx_new, unconstrained=unconstrained
+                            )
+                            loss = explainer.loss(ypred, pred_label, node_idx_new, epoch)
+                        loss.backward()
+
+                        explainer.optimizer.step()
+                        if explainer.scheduler is not None:
+                            explainer.scheduler.step()
+                    if warmup_stream is not None:
+                        torch.cuda.current_stream().wait_stream(warmup_stream)
+
+                if self.print_training or self.writer is not None:
+                    # .item() waits for the device, so only do it when the value is reported
+                    mask_density = explainer.mask_density().item()
                 if self.print_training:
                     print(
                         "epoch: ",
@@ -153,7 +217,7 @@ class Explainer:
                         "; loss: ",
                         loss.item(),
                         "; mask density: ",
-                        mask_density.item(),
+                        mask_density,
                         "; pred: ",
                         ypred,
                     )
@@ -181,7 +245,7 @@ class Explainer:
                             print("adj att size: ", adj_atts.size())
                             adj_att = torch.sum(adj_atts[0], dim=2)
                             # adj_att = adj_att[neighbors][:, neighbors]
-                            node_adj_att = adj_att * adj.float().cuda()
+                            node_adj_att = adj_att * explainer.adj
                             io_utils.log_matrix(
                                 self.writer, node_adj_att[0], "att/matrix", epoch
                             )
@@ -207,18 +271,138 @@ class Explainer:
             print("finished training in ", time.time() - begin_time)
             if model == "exp":
                 masked_adj = (
-                    explainer.masked_adj[0].cpu().detach().numpy() * sub_adj.squeeze()
+                    (explainer.masked_adj[0] * explainer.adj[0]).cpu().detach().numpy()
                 )
             else:
                 adj_atts = nn.functional.sigmoid(adj_atts).squeeze()
-                masked_adj = adj_atts.cpu().detach().numpy() * sub_adj.squeeze()
+                masked_adj = (adj_atts * explainer.adj[0]).cpu().detach().numpy()
+
+        self.save_masked_adj(masked_adj, node_idx)
+        return masked_adj
+
+    def explain_batch(self, node_indices, graph_idx=0, unconstrained=False):
+        """Explain several node predictions, a batch of nodes per optimization.
+
+        The adj of a batch is dense, so the work of an epoch grows with the square of the
+        batch's total number of nodes. Consecutive nodes are batched together as long as
+        their neighborhoods hold at most args.batch_max_nodes nodes.
+
+        Requires --sparse-mask, so that the mask only covers the in-block edges rather
+        than the whole block-diagonal adj. The optimizations run eagerly and nothing is
+        logged to tensorboard during them.
+
+        Returns the masked adjs, in the order of node_indices.
+        """
+        if not self.args.sparse_mask:
+            raise Exception("explain_batch requires --sparse-mask.")
+        masked_adjs = []
+        batch, batch_nodes = [], 0
+        for node_idx in node_indices:
+            num_neighbors = int(
+                np.count_nonzero(self.neighborhoods[graph_idx][node_idx])
+            )
+            if batch and batch_nodes + num_neighbors > self.args.batch_max_nodes:
+                masked_adjs += self.explain_block(batch, graph_idx, unconstrained)
+                batch, batch_nodes = [], 0
+            batch.append(node_idx)
+            batch_nodes += num_neighbors
+        if batch:
+            masked_adjs += self.explain_block(batch, graph_idx, unconstrained)
+        return masked_adjs
+
+    def explain_block(self, node_indices, graph_idx=0, unconstrained=False):
+        """Explain several node predictions with a single optimization.
+
+        The neighborhoods are the blocks of a block-diagonal adj. Since they do not share
+        edges, each block of the mask is optimized as if its node was explained alone.
+
+        Returns the masked adjs, in the order of node_indices.
+        """
+        device = self._adj_t.device
+        sub_adjs, sub_feats, sub_labels, pred_labels = [], [], [], []
+        node_indices_new, block_sizes = [], []
+        num_nodes = 0
+        for node_idx in node_indices:
+            node_idx_new, neighbors = self.neighbor_indices(node_idx, graph_idx)
+            neighbors_t = torch.from_numpy(neighbors).to(device)
+            sub_adjs.append(
+                self._adj_t[graph_idx]
+                .index_select(0, neighbors_t)
+                .index_select(1, neighbors_t)
+            )
+            sub_feats.append(self._feat_t[graph_idx].index_select(0, neighbors_t))
+            sub_labels.append(self.label[graph_idx][neighbors])
+            pred_labels.append(np.argmax(self.pred[graph_idx][neighbors], axis=1))
+            node_indices_new.append(num_nodes + node_idx_new)
+            block_sizes.append(len(neighbors))
+            num_nodes += len(neighbors)
+
+        adj = torch.block_diag(*sub_adjs).unsqueeze(0)
+        x = torch.cat(sub_feats, dim=0).unsqueeze(0).requires_grad_()
+        label = torch.tensor(
+            np.expand_dims(np.concatenate(sub_labels), axis=0), dtype=torch.long
+        )
+        pred_label = np.concatenate(pred_labels)
+        pred_label_t = torch.tensor(pred_label, dtype=torch.float, device=device)
+        node_idx_new = torch.tensor(node_indices_new, dtype=torch.long, device=device)
+
+        explainer = ExplainModule(
+            adj=adj,
+            x=x,
+            model=self.explain_model,
+            label=label,
+            pred_label_t=pred_label_t,
+            args=self.args,
+            writer=self.writer,
+            graph_idx=self.graph_idx,
+            block_sizes=block_sizes,
+        )
+        if self.args.gpu:
+            explainer = explainer.cuda()
+
+        self.model.eval()
+        explainer.train()
+        begin_time = time.time()
+        for epoch in range(self.args.num_epochs):
+            explainer.zero_grad(set_to_none=True)
+            explainer.optimizer.zero_grad(set_to_none=True)
+            with explainer.autocast():
+                ypred, _ = explainer(node_idx_new, unconstrained=unconstrained)
+                loss = explainer.loss(ypred, pred_label, node_idx_new, epoch)
+            loss.backward()
+
+            explainer.optimizer.step()
+            if explainer.scheduler is not None:
+                explainer.scheduler.step()
+
+            if self.print_training:
+                print(
+                    "epoch: ",
+                    epoch,
+                    "; loss: ",
+                    loss.item(),
+                    "; mask density: ",
+                    explainer.mask_density().item(),
+                )
+        print("finished training in ", time.time() - begin_time)
 
+        masked_adj = (explainer.masked_adj[0] * explainer.adj[0]).cpu().detach().numpy()
+        masked_adjs = []
+        start = 0
+        for node_idx, block_size in zip(node_indices, block_sizes):
+            end = start + block_size
+            masked_adjs.append(masked_adj[start:end, start:end])
+            self.save_masked_adj(masked_adjs[-1], node_idx)
+            start = end
+        return masked_adjs
+
+    def save_masked_adj(self, masked_adj, node_idx):
+        """Saves the masked adjacency matrix explaining a node to the log directory."""
         fname = 'masked_adj_' + io_utils.gen_explainer_prefix(self.args) + (
                 'node_idx_'+str(node_idx)+'graph_idx_'+str(self.graph_idx)+'.npy')
         with open(os.path.join(self.args.logdir, fname), 'wb') as outfile:
             np.save(outfile, np.asarray(masked_adj.copy()))
             print("Saved adjacency matrix to ", fname)
-        return masked_adj
 
 
     # NODE EXPLAINER
@@ -293,10 +477,19 @@ class Explainer:
 
 
     def explain_nodes_gnn_stats(self, node_indices, args, graph_idx=0, model="exp"):
-        masked_adjs = [
-            self.explain(node_idx, graph_idx=graph_idx, model=model)
-            for node_idx in node_indices
-        ]
+        if (
+            model == "exp"
+            and self.args.sparse_mask
+            and not self.args.cuda_graph
+            and self.writer is None
+        ):
+            # nothing is logged per epoch, so the nodes can share optimizations
+            masked_adjs = self.explain_batch(node_indices, graph_idx=graph_idx)
+        else:
+            masked_adjs = [
+                self.explain(node_idx, graph_idx=graph_idx, model=model)
+                for node_idx in node_indices
+            ]
         # pdb.set_trace()
         graphs = []
         feats = []
@@ -314,12 +507,13 @@ class Explainer:
             graphs.append(G)
             feats.append(denoised_feat)
             adjs.append(denoised_adj)
-            io_utils.log_graph(
-                self.writer,
-                G,
-                "graph/{}_{}_{}".format(self.args.dataset, model, i),
-                identify_self=True,
-            )
+            if self.writer is not None:
+                io_utils.log_graph(
+                    self.writer,
+                    G,
+                    "graph/{}_{}_{}".format(self.args.dataset, model, i),
+                    identify_self=True,
+                )
 
         pred_all = np.concatenate((pred_all), axis=0)
         real_all = np.concatenate((real_all), axis=0)
@@ -440,7 +634,7 @@ class Explainer:
                 ax = plt.subplot(2, topk, i * topk + j + 1)
                 nx.draw(
                     G,
-                    pos=nx.spring_layout(G),
+                    pos=nx.spring_layout(G, seed=0),
                     with_labels=True,
                     font_size=4,
                     node_color=node_colors,
@@ -464,20 +658,19 @@ class Explainer:
         experiment using representer theorem for finding supporting instances.
         https://papers.nips.cc/paper/8141-representer-point-selection-for-explaining-deep-neural-networks.pdf
         """
-        self.model.train()
-        self.model.zero_grad()
+        self.model.eval()
         adj = torch.tensor(self.adj, dtype=torch.float)
-        x = torch.tensor(self.feat, requires_grad=True, dtype=torch.float)
+        x = torch.tensor(self.feat, dtype=torch.float)
         label = torch.tensor(self.label, dtype=torch.long)
         if self.args.gpu:
             adj, x, label = adj.cuda(), x.cuda(), label.cuda()
 
-        preds, _ = self.model(x, adj)
-        preds.retain_grad()
-        self.embedding = self.model.embedding_tensor
-        loss = self.model.loss(preds, label)
-        loss.backward()
-        self.preds_grad = preds.grad
+        with torch.enable_grad():
+            preds, _ = self.model(x, adj)
+            self.embedding = self.model.embedding_tensor
+            loss = self.model.loss(preds, label)
+            # only the gradient w.r.t. the predictions is needed, not the parameters'
+            self.preds_grad = torch.autograd.grad(loss, preds)[0]
         pred_idx = np.expand_dims(np.argmax(self.pred, axis=2), axis=2)
         pred_idx = torch.LongTensor(pred_idx)
         if self.args.gpu:
@@ -486,12 +679,17 @@ class Explainer:
 
 
     # Utilities
-    def extract_neighborhood(self, node_idx, graph_idx=0):
-        """Returns the neighborhood of a given ndoe."""
+    def neighbor_indices(self, node_idx, graph_idx=0):
+        """Returns the index of a given node in its neighborhood, and the neighborhood."""
         neighbors_adj_row = self.neighborhoods[graph_idx][node_idx, :]
         # index of the query node in the new adj
-        node_idx_new = sum(neighbors_adj_row[:node_idx])
+        node_idx_new = int(np.count_nonzero(neighbors_adj_row[:node_idx]))
         neighbors = np.nonzero(neighbors_adj_row)[0]
+        return node_idx_new, neighbors
+
+    def extract_neighborhood(self, node_idx, graph_idx=0):
+        """Returns the neighborhood of a given ndoe."""
+        node_idx_new, neighbors = self.neighbor_indices(node_idx, graph_idx)
         sub_adj = self.adj[graph_idx][neighbors][:, neighbors]
         sub_feat = self.feat[graph_idx, neighbors]
         sub_label = self.label[graph_idx][neighbors]
@@ -576,6 +774,17 @@ class Explainer:
         return pred, real
 
 
+@torch.jit.script
+def _masked_adj_kernel(mask: torch.Tensor, adj: torch.Tensor):
+    """Fused sigmoid, symmetrization and masking of the adjacency matrix."""
+    sym_mask = torch.sigmoid(mask)
+    sym_mask = (sym_mask + sym_mask.t()) / 2
+    masked_adj = adj * sym_mask
+    # the product is not needed by its own backward, so it can be modified in place
+    torch.diagonal(masked_adj, 0, -2, -1).zero_()
+    return masked_adj
+
+
 class ExplainModule(nn.Module):
     def __init__(
         self,
@@ -584,16 +793,24 @@ class ExplainModule(nn.Module):
         model,
         label,
         args,
+        pred_label_t=None,
         graph_idx=0,
         writer=None,
         use_sigmoid=True,
         graph_mode=False,
+        block_sizes=None,
     ):
         super(ExplainModule, self).__init__()
-        self.adj = adj
+        # move the inputs to the GPU once instead of at every epoch
+        if args.gpu:
+            adj = adj.cuda()
+            x = x.detach().cuda().requires_grad_(x.requires_grad)
+            label = label.cuda()
+        self.register_buffer("adj", adj)
         self.x = x
         self.model = model
         self.label = label
+        self.pred_label_t = pred_label_t
         self.graph_idx = graph_idx
         self.args = args
         self.writer = writer
@@ -603,20 +820,62 @@ class ExplainModule(nn.Module):
 
         init_strategy = "normal"
         num_nodes = adj.size()[1]
+        if args.sparse_mask:
+            # only the existing edges get a mask entry, shared by both directions
+            sym_adj = adj[0] + adj[0].t()
+            edge_index = torch.triu(sym_adj, diagonal=1).nonzero().t()
+            self.register_buffer("edge_index", edge_index)
+            num_edges = edge_index.size(1)
+        else:
+            self.register_buffer("edge_index", None)
+            num_edges = None
+        # several subgraphs can be explained at once as the blocks of a block-diagonal adj
+        if block_sizes is None:
+            block_sizes = [num_nodes]
+        self.num_blocks = len(block_sizes)
+        block_sizes = torch.tensor(block_sizes, device=adj.device)
+        self.register_buffer(
+            "block_index",
+            torch.repeat_interleave(
+                torch.arange(self.num_blocks, device=adj.device), block_sizes
+            ),
+        )
+        # losses are normalized per block, as if each subgraph was explained alone
+        self.register_buffer(
+            "node_weight", 1.0 / block_sizes.float()[self.block_index] ** 2
+        )
+        if self.num_blocks == 1:
+            mask_weight = None
+            edge_nodes = None
+        else:
+            # blocks are only supported with the sparse mask, see Explainer.explain_batch
+            edge_block = self.block_index[self.edge_index[0]]
+            block_edges = torch.bincount(edge_block, minlength=self.num_blocks)
+            mask_weight = 1.0 / block_edges.float()[edge_block]
+            edge_nodes = block_sizes[edge_block]
+        self.register_buffer("mask_weight", mask_weight)
+
         self.mask, self.mask_bias = self.construct_edge_mask(
-            num_nodes, init_strategy=init_strategy
+            num_nodes,
+            init_strategy=init_strategy,
+            num_edges=num_edges,
+            edge_nodes=edge_nodes,
         )
 
-        self.feat_mask = self.construct_feat_mask(x.size(-1), init_strategy="constant")
+        self.feat_mask = self.construct_feat_mask(
+            x.size(-1), init_strategy="constant", num_blocks=self.num_blocks
+        )
         params = [self.mask, self.feat_mask]
         if self.mask_bias is not None:
             params.append(self.mask_bias)
-        # For masking diagonal entries
-        self.diag_mask = torch.ones(num_nodes, num_nodes) - torch.eye(num_nodes)
-        if args.gpu:
-            self.diag_mask = self.diag_mask.cuda()
+        # adj is constant during the optimization, so its sum is computed once
+        self.adj_sum = torch.sum(self.adj).item()
 
         self.scheduler, self.optimizer = train_utils.build_optimizer(args, params)
+        if args.gpu and args.cuda_graph and args.opt in CAPTURABLE_OPTIMIZERS:
+            # keep the optimizer state on the device so that step() can be captured
+            for param_group in self.optimizer.param_groups:
+                param_group["capturable"] = True
 
         self.coeffs = {
             "size": 0.005,
@@ -627,8 +886,9 @@ class ExplainModule(nn.Module):
             "lap": 1.0,
         }
 
-    def construct_feat_mask(self, feat_dim, init_strategy="normal"):
-        mask = nn.Parameter(torch.FloatTensor(feat_dim))
+    def construct_feat_mask(self, feat_dim, init_strategy="normal", num_blocks=1):
+        mask_size = (feat_dim,) if num_blocks == 1 else (num_blocks, feat_dim)
+        mask = nn.Parameter(torch.FloatTensor(*mask_size))
         if init_strategy == "normal":
             std = 0.1
             with torch.no_grad():
@@ -639,14 +899,34 @@ class ExplainModule(nn.Module):
                 # mask[0] = 2
         return mask
 
-    def construct_edge_mask(self, num_nodes, init_strategy="normal", const_val=1.0):
-        mask = nn.Parameter(torch.FloatTensor(num_nodes, num_nodes))
+    def construct_edge_mask(
+        self,
+        num_nodes,
+        init_strategy="normal",
+        const_val=1.0,
+        num_edges=None,
+        edge_nodes=None,
+    ):
+        """The mask is N x N, or has a single entry per edge when num_edges is given.
+
+        edge_nodes holds, for each edge, the size of the subgraph it belongs to, so that
+        the init std of a batched mask matches the one of a single subgraph.
+        """
+        mask_size = (num_nodes, num_nodes) if num_edges is None else (num_edges,)
+        mask = nn.Parameter(torch.FloatTensor(*mask_size))
         if init_strategy == "normal":
-            std = nn.init.calculate_gain("relu") * math.sqrt(
-                2.0 / (num_nodes + num_nodes)
-            )
-            with torch.no_grad():
-                mask.normal_(1.0, std)
+            if edge_nodes is None:
+                std = nn.init.calculate_gain("relu") * math.sqrt(
+                    2.0 / (num_nodes + num_nodes)
+                )
+                with torch.no_grad():
+                    mask.normal_(1.0, std)
+            else:
+                std = nn.init.calculate_gain("relu") * torch.sqrt(
+                    2.0 / (edge_nodes + edge_nodes).float().cpu()
+                )
+                with torch.no_grad():
+                    mask.normal_(0.0, 1.0).mul_(std).add_(1.0)
                 # mask.clamp_(0.0, 1.0)
         elif init_strategy == "const":
             nn.init.constant_(mask, const_val)
@@ -659,34 +939,48 @@ class ExplainModule(nn.Module):
 
         return mask, mask_bias
 
+    def _symmetrize(self, mask):
+        if self.edge_index is None:
+            return (mask + mask.t()) / 2
+        # scatter the per-edge entries into both directions of a dense matrix
+        row, col = self.edge_index
+        sym_mask = self.adj.new_zeros(self.adj.size()[1:])
+        sym_mask = sym_mask.index_put((row, col), mask)
+        return sym_mask.index_put((col, row), mask)
+
     def _masked_adj(self):
+        if (
+            self.mask_act == "sigmoid"
+            and not self.args.mask_bias
+            and self.edge_index is None
+        ):
+            return _masked_adj_kernel(self.mask, self.adj)
         sym_mask = self.mask
         if self.mask_act == "sigmoid":
             sym_mask = torch.sigmoid(self.mask)
         elif self.mask_act == "ReLU":
-            sym_mask = nn.ReLU()(self.mask)
-        sym_mask = (sym_mask + sym_mask.t()) / 2
-        adj = self.adj.cuda() if self.args.gpu else self.adj
-        masked_adj = adj * sym_mask
+            sym_mask = torch.relu(self.mask)
+        sym_mask = self._symmetrize(sym_mask)
+        masked_adj = self.adj * sym_mask
         if self.args.mask_bias:
             bias = (self.mask_bias + self.mask_bias.t()) / 2
-            bias = nn.ReLU6()(bias * 6) / 6
+            bias = torch.clamp(bias, 0.0, 1.0)
             masked_adj += (bias + bias.t()) / 2
-        return masked_adj * self.diag_mask
+        # mask the diagonal entries in O(N) rather than multiplying by an N x N mask
+        torch.diagonal(masked_adj, 0, -2, -1).zero_()
+        return masked_adj
 
     def mask_density(self):
-        mask_sum = torch.sum(self._masked_adj()).cpu()
-        adj_sum = torch.sum(self.adj)
-        return mask_sum / adj_sum
+        # reuses the masked adj cached by the last forward pass
+        return torch.sum(self.masked_adj) / self.adj_sum
 
     def forward(self, node_idx, unconstrained=False, mask_features=True, marginalize=False):
-        x = self.x.cuda() if self.args.gpu else self.x
+        x = self.x
 
         if unconstrained:
             sym_mask = torch.sigmoid(self.mask) if self.use_sigmoid else self.mask
-            self.masked_adj = (
-                torch.unsqueeze((sym_mask + sym_mask.t()) / 2, 0) * self.diag_mask
-            )
+            self.masked_adj = torch.unsqueeze(self._symmetrize(sym_mask), 0)
+            torch.diagonal(self.masked_adj, 0, -2, -1).zero_()
         else:
             self.masked_adj = self._masked_adj()
             if mask_features:
@@ -695,6 +989,9 @@ class ExplainModule(nn.Module):
                     if self.use_sigmoid
                     else self.feat_mask
                 )
+                if self.num_blocks > 1:
+                    # each node uses the feature mask of its subgraph
+                    feat_mask = feat_mask[self.block_index]
                 if marginalize:
                     std_tensor = torch.ones_like(x, dtype=torch.float) / 2
                     mean_tensor = torch.zeros_like(x, dtype=torch.float) - x
@@ -705,30 +1002,56 @@ class ExplainModule(nn.Module):
 
         ypred, adj_att = self.model(x, self.masked_adj)
         if self.graph_mode:
-            res = nn.Softmax(dim=0)(ypred[0])
+            res = torch.softmax(ypred[0], dim=0)
         else:
             node_pred = ypred[self.graph_idx, node_idx, :]
-            res = nn.Softmax(dim=0)(node_pred)
+            res = torch.softmax(node_pred, dim=-1)
         return res, adj_att
 
+    def autocast(self, cache_enabled=True):
+        """Runs the forward pass and loss in bfloat16 when args.amp is set.
+
+        The masks stay in float32, and bfloat16 has the float32 range, so no gradient scaling
+        is needed.
+        """
+        if not self.args.amp:
+            return contextlib.nullcontext()
+        return torch.autocast(
+            device_type=self.adj.device.type,
+            dtype=torch.bfloat16,
+            cache_enabled=cache_enabled,
+        )
+
+    def capture_step(self, node_idx, pred_label, unconstrained=False, pool=None):
+        """Records one optimization step of the masks into a CUDA graph.
+
+        Returns the graph and the (ypred, adj_att, loss) tensors refreshed by each replay.
+        """
+        step_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(step_graph, pool=pool):
+            # gradients are zeroed in place so that every replay reuses the same buffers
+            self.zero_grad(set_to_none=False)
+            self.optimizer.zero_grad(set_to_none=False)
+            # cached casts would not be refreshed by the replays
+            with self.autocast(cache_enabled=False):
+                ypred, adj_att = self(node_idx, unconstrained=unconstrained)
+                loss = self.loss(ypred, pred_label, node_idx, epoch=0)
+            loss.backward()
+            self.optimizer.step()
+        return step_graph, (ypred, adj_att, loss)
+
     def adj_feat_grad(self, node_idx, pred_label_node):
-        self.model.zero_grad()
+        self.model.zero_grad(set_to_none=True)
         self.adj.requires_grad = True
         self.x.requires_grad = True
-        if self.adj.grad is not None:
-            self.adj.grad.zero_()
-            self.x.grad.zero_()
-        if self.args.gpu:
-            adj = self.adj.cuda()
-            x = self.x.cuda()
-            label = self.label.cuda()
-        else:
-            x, adj = self.x, self.adj
-        ypred, _ = self.model(x, adj)
+        # adj and x are not parameters, so their gradients are released here
+        self.adj.grad = None
+        self.x.grad = None
+        ypred, _ = self.model(self.x, self.adj)
         if self.graph_mode:
-            logit = nn.Softmax(dim=0)(ypred[0])
+            logit = torch.softmax(ypred[0], dim=0)
         else:
-            logit = nn.Softmax(dim=0)(ypred[self.graph_idx, node_idx, :])
+            logit = torch.softmax(ypred[self.graph_idx, node_idx, :], dim=0)
         logit = logit[pred_label_node]
         loss = -torch.log(logit)
         loss.backward()
@@ -744,54 +1067,57 @@ class ExplainModule(nn.Module):
         if mi_obj:
             pred_loss = -torch.sum(pred * torch.log(pred))
         else:
-            pred_label_node = pred_label if self.graph_mode else pred_label[node_idx]
             gt_label_node = self.label if self.graph_mode else self.label[0][node_idx]
-            logit = pred[gt_label_node]
-            pred_loss = -torch.log(logit)
+            # gather rather than a 0-dim index, which would be read back to the host
+            logit = torch.gather(pred, -1, gt_label_node.unsqueeze(-1))
+            pred_loss = -torch.sum(torch.log(logit))
         # size
         mask = self.mask
         if self.mask_act == "sigmoid":
             mask = torch.sigmoid(self.mask)
         elif self.mask_act == "ReLU":
-            mask = nn.ReLU()(self.mask)
+            mask = torch.relu(self.mask)
         size_loss = self.coeffs["size"] * torch.sum(mask)
 
         # pre_mask_sum = torch.sum(self.feat_mask)
         feat_mask = (
             torch.sigmoid(self.feat_mask) if self.use_sigmoid else self.feat_mask
         )
-        feat_size_loss = self.coeffs["feat_size"] * torch.mean(feat_mask)
+        feat_size_loss = self.coeffs["feat_size"] * torch.sum(torch.mean(feat_mask, -1))
 
         # entropy
         mask_ent = -mask * torch.log(mask) - (1 - mask) * torch.log(1 - mask)
-        mask_ent_loss = self.coeffs["ent"] * torch.mean(mask_ent)
+        if self.mask_weight is None:
+            mask_ent_loss = self.coeffs["ent"] * torch.mean(mask_ent)
+        else:
+            mask_ent_loss = self.coeffs["ent"] * torch.sum(mask_ent * self.mask_weight)
 
         feat_mask_ent = - feat_mask             \
                         * torch.log(feat_mask)  \
                         - (1 - feat_mask)       \
                         * torch.log(1 - feat_mask)
 
-        feat_mask_ent_loss = self.coeffs["feat_ent"] * torch.mean(feat_mask_ent)
+        feat_mask_ent_loss = self.coeffs["feat_ent"] * torch.sum(
+            torch.mean(feat_mask_ent, -1)
+        )
 
         # laplacian
-        D = torch.diag(torch.sum(self.masked_adj[0], 0))
-        m_adj = self.masked_adj if self.graph_mode else self.masked_adj[self.graph_idx]
-        L = D - m_adj
-        pred_label_t = torch.tensor(pred_label, dtype=torch.float)
-        if self.args.gpu:
-            pred_label_t = pred_label_t.cuda()
-            L = L.cuda()
         if self.graph_mode:
             lap_loss = 0
         else:
-            lap_loss = (self.coeffs["lap"]
-                * (pred_label_t @ L @ pred_label_t)
-                / self.adj.numel()
+            m_adj = self.masked_adj[self.graph_idx]
+            pred_label_t = self.pred_label_t
+            # y^T L y = sum(deg * y^2) - y^T A y, without building D and L;
+            # the per-node terms are weighted by 1 / n^2 of their subgraph
+            deg = torch.sum(m_adj, 0)
+            lap_quad = deg * pred_label_t * pred_label_t - pred_label_t * (
+                m_adj @ pred_label_t
             )
+            lap_loss = self.coeffs["lap"] * torch.sum(lap_quad * self.node_weight)
 
         # grad
         # adj
-        # adj_grad, x_grad = self.adj_feat_grad(node_idx, pred_label_node)
+        # adj_grad, x_grad = self.adj_feat_grad(node_idx, pred_label[node_idx])
         # adj_grad = adj_grad[self.graph_idx]
         # x_grad = x_grad[self.graph_idx]
         # if self.args.gpu:
@@ -817,54 +1143,18 @@ class ExplainModule(nn.Module):
         return loss
 
     def log_mask(self, epoch):
-        plt.switch_backend("agg")
-        fig = plt.figure(figsize=(4, 3), dpi=400)
-        plt.imshow(self.mask.cpu().detach().numpy(), cmap=plt.get_cmap("BuPu"))
-        cbar = plt.colorbar()
-        cbar.solids.set_edgecolor("face")
-
-        plt.tight_layout()
-        fig.canvas.draw()
-        self.writer.add_image(
-            "mask/mask", tensorboardX.utils.figure_to_image(fig), epoch
-        )
-
-        # fig = plt.figure(figsize=(4,3), dpi=400)
-        # plt.imshow(self.feat_mask.cpu().detach().numpy()[:,np.newaxis], cmap=plt.get_cmap('BuPu'))
-        # cbar = plt.colorbar()
-        # cbar.solids.set_edgecolor("face")
+        mask = self.mask if self.edge_index is None else self._symmetrize(self.mask)
+        io_utils.log_matrix_image(self.writer, mask, "mask/mask", epoch)
 
-        # plt.tight_layout()
-        # fig.canvas.draw()
-        # self.writer.add_image('mask/feat_mask', tensorboardX.utils.figure_to_image(fig), epoch)
         io_utils.log_matrix(
             self.writer, torch.sigmoid(self.feat_mask), "mask/feat_mask", epoch
         )
 
-        fig = plt.figure(figsize=(4, 3), dpi=400)
         # use [0] to remove the batch dim
-        plt.imshow(self.masked_adj[0].cpu().detach().numpy(), cmap=plt.get_cmap("BuPu"))
-        cbar = plt.colorbar()
-        cbar.solids.set_edgecolor("face")
-
-        plt.tight_layout()
-        fig.canvas.draw()
-        self.writer.add_image(
-            "mask/adj", tensorboardX.utils.figure_to_image(fig), epoch
-        )
+        io_utils.log_matrix_image(self.writer, self.masked_adj[0], "mask/adj", epoch)
 
         if self.args.mask_bias:
-            fig = plt.figure(figsize=(4, 3), dpi=400)
-            # use [0] to remove the batch dim
-            plt.imshow(self.mask_bias.cpu().detach().numpy(), cmap=plt.get_cmap("BuPu"))
-            cbar = plt.colorbar()
-            cbar.solids.set_edgecolor("face")
-
-            plt.tight_layout()
-            fig.canvas.draw()
-            self.writer.add_image(
-                "mask/bias", tensorboardX.utils.figure_to_image(fig), epoch
-            )
+            io_utils.log_matrix_image(self.writer, self.mask_bias, "mask/bias", epoch)
 
     def log_adj_grad(self, node_idx, pred_label, epoch, label=None):
         log_adj = False
@@ -895,7 +1185,7 @@ class ExplainModule(nn.Module):
         # visualization
         if self.graph_mode:
             G = io_utils.denoise_graph(
-                masked_adj, node_idx, feat=self.x[0], threshold=None, max_component=False
+                masked_adj, node_idx, feat=self.x[0].cpu(), threshold=None, max_component=False
             )
             io_utils.log_graph(
                 self.writer,
@@ -910,13 +1200,13 @@ class ExplainModule(nn.Module):
             )
         io_utils.log_matrix(self.writer, x_grad, "grad/feat", epoch)
 
-        adj_grad = adj_grad.detach().numpy()
+        adj_grad = adj_grad.cpu().detach().numpy()
         if self.graph_mode:
             print("GRAPH model")
             G = io_utils.denoise_graph(
                 adj_grad,
                 node_idx,
-                feat=self.x[0],
+                feat=self.x[0].cpu(),
                 threshold=0.0003,  # threshold_num=20,
                 max_component=True,
             )
@@ -947,7 +1237,7 @@ class ExplainModule(nn.Module):
             G = io_utils.denoise_graph(
                 masked_adj,
                 node_idx,
-                feat=self.x[0],
+                feat=self.x[0].cpu(),
                 threshold=0.2,  # threshold_num=20,
                 max_component=True,
             )
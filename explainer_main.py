@@ -44,6 +44,30 @@ def arg_parse():
         default=False,
         help="whether to use GPU.",
     )
+    parser.add_argument(
+        "--cuda-graph",
+        dest="cuda_graph",
+        action="store_const",
+        const=True,
+        default=False,
+        help="whether to replay the explainer optimization step from a CUDA graph.",
+    )
+    parser.add_argument(
+        "--compile",
+        dest="compile",
+        action="store_const",
+        const=True,
+        default=False,
+        help="whether to compile the GCN forward pass once with torch.compile.",
+    )
+    parser.add_argument(
+        "--amp",
+        dest="amp",
+        action="store_const",
+        const=True,
+        default=False,
+        help="whether to run the explainer forward pass in bfloat16 mixed precision.",
+    )
     parser.add_argument(
         "--epochs", dest="num_epochs", type=int, help="Number of epochs to train."
     )
@@ -94,6 +118,20 @@ def arg_parse():
         default=False,
         help="Whether to add bias. Default to True.",
     )
+    parser.add_argument(
+        "--sparse-mask",
+        dest="sparse_mask",
+        action="store_const",
+        const=True,
+        default=False,
+        help="whether to learn mask entries only for the edges of the graph.",
+    )
+    parser.add_argument(
+        "--batch-max-nodes",
+        dest="batch_max_nodes",
+        type=int,
+        help="Maximum number of nodes in one block-diagonal batch of explanations.",
+    )
     parser.add_argument(
         "--explain-node", dest="explain_node", type=int, help="Node to explain."
     )
@@ -164,6 +202,7 @@ def arg_parse():
         mask_act="sigmoid",
         multigraph_class=-1,
         multinode_class=-1,
+        batch_max_nodes=256,
     )
     return parser.parse_args()
 
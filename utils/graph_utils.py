@@ -4,6 +4,7 @@
 """
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp
 import torch
 import torch.utils.data
 
@@ -144,15 +145,19 @@ class GraphSampler(torch.utils.data.Dataset):
             "assign_feats": self.assign_feat_all[idx].copy(),
         }
 
-def neighborhoods(adj, n_hops, use_cuda):
-    """Returns the n_hops degree adjacency matrix adj."""
-    adj = torch.tensor(adj, dtype=torch.float)
-    if use_cuda:
-        adj = adj.cuda()
-    hop_adj = power_adj = adj
-    for i in range(n_hops - 1):
-        power_adj = power_adj @ adj
-        prev_hop_adj = hop_adj
-        hop_adj = hop_adj + power_adj
-        hop_adj = (hop_adj > 0).float()
-    return hop_adj.cpu().numpy().astype(int)
\ No newline at end of file
+def neighborhoods(adj, n_hops):
+    """Returns the n_hops degree adjacency matrix adj.
+
+    Reachability is accumulated with sparse boolean products instead of dense
+    matrix powers, since only the sparsity pattern of each power is kept.
+    """
+    hop_adjs = []
+    for graph_adj in adj:
+        # boolean CSR products use OR/AND, so path counts never overflow
+        graph_adj = sp.csr_matrix(np.asarray(graph_adj) > 0, dtype=bool)
+        hop_adj = power_adj = graph_adj
+        for i in range(n_hops - 1):
+            power_adj = power_adj @ graph_adj
+            hop_adj = hop_adj + power_adj
+        hop_adjs.append(hop_adj.toarray().astype(np.uint8))
+    return np.stack(hop_adjs)
@@ -190,6 +190,24 @@ def log_matrix(writer, mat, name, epoch, fig_size=(8, 6), dpi=200):
     writer.add_image(name, tensorboardX.utils.figure_to_image(fig), epoch)
 
 
+def log_matrix_image(writer, mat, name, epoch, cmap="BuPu"):
+    """Save a colormapped image of a matrix, without rendering a figure.
+
+    Args:
+        - writer    :  A file writer.
+        - mat       :  The matrix to write.
+        - name      :  Name of the image.
+        - epoch     :  Epoch number.
+        - cmap      :  Name of the matplotlib colormap.
+    """
+    mat = mat.cpu().detach().numpy()
+    if mat.ndim == 1:
+        mat = mat[:, np.newaxis]
+    mat = (mat - mat.min()) / (mat.max() - mat.min() + 1e-8)
+    img = plt.get_cmap(cmap)(mat)[..., :3]
+    writer.add_image(name, img, epoch, dataformats="HWC")
+
+
 def denoise_graph(adj, node_idx, feat=None, label=None, threshold=None, threshold_num=None, max_component=True):
     """Cleaning a graph by thresholding its node values.
 
@@ -222,19 +240,15 @@ def denoise_graph(adj, node_idx, feat=None, label=None, threshold=None, threshol
         threshold = np.sort(adj[adj > 0])[-threshold_num]
 
     if threshold is not None:
-        weighted_edge_list = [
-            (i, j, adj[i, j])
-            for i in range(num_nodes)
-            for j in range(num_nodes)
-            if adj[i, j] >= threshold
-        ]
+        edge_mask = adj >= threshold
     else:
-        weighted_edge_list = [
-            (i, j, adj[i, j])
-            for i in range(num_nodes)
-            for j in range(num_nodes)
-            if adj[i, j] > 1e-6
-        ]
+        edge_mask = adj > 1e-6
+    # adj is symmetric and G is undirected: the upper triangle holds every edge
+    edge_mask = np.triu(edge_mask)
+    rows, cols = np.nonzero(edge_mask)
+    weighted_edge_list = list(
+        zip(rows.tolist(), cols.tolist(), adj[edge_mask].tolist())
+    )
     G.add_weighted_edges_from(weighted_edge_list)
     if max_component:
         largest_cc = max(nx.connected_components(G), key=len)
@@ -580,7 +594,8 @@ def read_biosnap(datadir, edgelist_file, label_file, feat_file=None, concat=True
     G.add_edges_from(data)
     print("Total nodes: ", G.number_of_nodes())
 
-    G = max(nx.connected_component_subgraphs(G), key=len)
+    # connected_component_subgraphs was removed in NetworkX 2.4
+    G = G.subgraph(max(nx.connected_components(G), key=len)).copy()
     print("Total nodes in largest connected component: ", G.number_of_nodes())
 
     df = pd.read_csv(os.path.join(datadir, label_file), delimiter="\t", usecols=[0, 1])
@@ -698,7 +713,7 @@ def log_graph2(adj, batch_num_nodes, writer, epoch, batch_idx, assign_tensor=Non
         G = nx.from_numpy_matrix(adj_matrix)
         nx.draw(
             G,
-            pos=nx.spring_layout(G),
+            pos=nx.spring_layout(G, seed=0),
             with_labels=True,
             node_color="#336699",
             edge_color="grey",
@@ -752,7 +767,7 @@ def log_graph2(adj, batch_num_nodes, writer, epoch, batch_idx, assign_tensor=Non
         G = nx.from_numpy_matrix(adj_matrix)
         nx.draw(
             G,
-            pos=nx.spring_layout(G),
+            pos=nx.spring_layout(G, seed=0),
             with_labels=False,
             node_color=node_colors,
             edge_color="grey",